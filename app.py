@@ -1,22 +1,49 @@
 """Flask app for feedback."""
 
-from flask import Flask, flash, redirect, render_template, session
+import os
+
+from flask import (Flask, Response, abort, flash, g, jsonify, redirect,
+                   render_template, request, session)
 from werkzeug.exceptions import Unauthorized
 
+from feedback_events import FeedbackEventHub
 from forms import FeedbackForm, LoginUserForm, RegisterUserForm
-from models import Feedback, User, connect_db, db
+from models import Feedback, FeedbackRevision, User, connect_db, db
+from request_profiler import RequestProfiler
+from revision_writer import RevisionWriter
 from secret_keys import APP_SECRET_KEY
 
 # ==================================================
 
 
 def create_app(db_name, testing=False):
+    """
+    Creates the app.
+    db_name is either the name of a local PostgreSQL database, or a full database
+    URI, such as "sqlite:////var/lib/feedback/feedback.db" to run without a
+    database server.  SQLite databases need to be files, not in memory, since the
+    revision writer uses its own connection.
+    """
+
     app = Flask(__name__)
 
-    app.config["SQLALCHEMY_DATABASE_URI"] = f"postgresql://postgres@localhost/{
-        db_name}"
+    if "://" in db_name:
+        app.config["SQLALCHEMY_DATABASE_URI"] = db_name
+    else:
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"postgresql://postgres@localhost/{
+            db_name}"
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+    if app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        # Each thread checks out its own connection from the pool.  The pool holds
+        # enough connections for the threads of a single node, so they are kept
+        # open and reused instead of reconnecting per request.
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            "connect_args": {"check_same_thread": False},
+            "pool_size": 10,
+            "max_overflow": 10,
+        }
+
     app.config["SECRET_KEY"] = APP_SECRET_KEY
 
     if not testing:
@@ -26,6 +53,62 @@ def create_app(db_name, testing=False):
 
         app.config["TESTING"] = True
 
+    # Feedback content longer than this many characters is stored compressed.
+    # None turns compression off.
+    app.config["FEEDBACK_COMPRESSION_THRESHOLD"] = None
+
+    app.config["REVISION_BATCH_SIZE"] = 50
+    app.config["REVISION_FLUSH_INTERVAL"] = 1.0
+    app.config["REVISION_MAX_BUFFER_SIZE"] = 10000
+    # Seconds to wait before retrying a failed insert, doubled on every failure.
+    app.config["REVISION_RETRY_INTERVAL"] = 0.5
+    # Seconds a failing batch is retried before saving what can be saved of it.
+    app.config["REVISION_GIVE_UP_AFTER"] = 300
+    # Seconds close() keeps retrying at shutdown.
+    app.config["REVISION_CLOSE_TIMEOUT"] = 5
+
+    app.extensions["revision_writer"] = RevisionWriter(app)
+
+    # Send feedback events through PostgreSQL NOTIFY, so that every worker's
+    # admins get them.  Only used with a PostgreSQL database.
+    app.config["FEEDBACK_EVENTS_PG_NOTIFY"] = False
+    # Seconds between keepalive comments on an idle events stream.
+    app.config["FEEDBACK_EVENTS_KEEPALIVE"] = 15
+
+    app.extensions["feedback_events"] = FeedbackEventHub(app)
+
+    # Percentage of all requests, and endpoints with all of their requests, to
+    # profile.  Admins can change these at /admin/profiler, but only for the
+    # worker process that handles the change; set them here, or run a single
+    # process, to profile every worker.
+    app.config["PROFILER_SAMPLE_PERCENT"] = 0
+    app.config["PROFILER_ENDPOINTS"] = set()
+    # Seconds between samples of a profiled request's stack.
+    app.config["PROFILER_INTERVAL"] = 0.005
+    # Seconds between writes of the profiles to PROFILER_OUTPUT_DIR.
+    app.config["PROFILER_WRITE_INTERVAL"] = 10
+    app.config["PROFILER_OUTPUT_DIR"] = os.path.join(app.instance_path, "profiles")
+
+    app.extensions["request_profiler"] = RequestProfiler(app)
+
+    @app.before_request
+    def start_profiling():
+        """Starts profiling the request, if it is chosen for profiling."""
+
+        profiler = app.extensions["request_profiler"]
+
+        # Requests for unknown URLs have no endpoint.
+        if request.endpoint and profiler.should_profile(request.endpoint):
+            profiler.start(request.endpoint)
+            g.profiling = True
+
+    @app.teardown_request
+    def stop_profiling(exception):
+        """Stops profiling the request, if it was being profiled."""
+
+        if g.pop("profiling", False):
+            app.extensions["request_profiler"].stop()
+
     # --------------------------------------------------
 
     @app.route("/")
@@ -159,6 +242,85 @@ def create_app(db_name, testing=False):
         flash("Delete request sent.")
         return redirect(f"/users/{username}")
 
+    @app.route("/feedback/<int:feedback_id>/history")
+    def feedback_history(feedback_id):
+        """Shows the edit history of a feedback, including deleted feedbacks."""
+
+        # Checked first, so that anonymous requests cannot make the writer flush,
+        # or find out which feedbacks exist.
+        __authorize_logged_in()
+
+        # Make sure revisions that are still buffered are shown.  If they cannot
+        # be written now, show the revisions that already are.
+        try:
+            app.extensions["revision_writer"].flush()
+        except Exception:
+            app.logger.exception("Failed to write feedback revisions.")
+
+        revisions = FeedbackRevision.history(feedback_id)
+        if not revisions:
+            abort(404)
+
+        __authorize_session_user_to_access(revisions[0].username)
+
+        return render_template("feedback_history.html",
+                               feedback_id=feedback_id, revisions=revisions)
+
+    @app.route("/admin/feedback/events")
+    def feedback_events():
+        """Streams feedback additions, updates, and deletions to admins as server-sent events."""
+
+        __authorize_admin()
+
+        stream = app.extensions["feedback_events"].stream(
+            app.config["FEEDBACK_EVENTS_KEEPALIVE"])
+
+        return Response(stream, mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache",
+                                 "X-Accel-Buffering": "no"})
+
+    @app.route("/admin/profiler", methods=["GET", "POST"])
+    def profiler_settings():
+        """
+        Shows the profiler's settings and a summary of the profiles taken.
+        Changes the settings from the form fields sample_percent (0-100) and
+        endpoints (comma-separated endpoint names), if given.
+
+        Settings and profiles are per process.  With several worker processes, this
+        only shows and changes the worker that handles the request, given as pid.
+        """
+
+        __authorize_admin()
+
+        if request.method == "POST":
+            if "sample_percent" in request.form:
+                try:
+                    sample_percent = float(request.form["sample_percent"])
+                except ValueError:
+                    sample_percent = None
+
+                if sample_percent is None or not 0 <= sample_percent <= 100:
+                    abort(400, "sample_percent needs to be a number from 0-100, inclusive.")
+
+                app.config["PROFILER_SAMPLE_PERCENT"] = sample_percent
+
+            if "endpoints" in request.form:
+                endpoints = {endpoint.strip()
+                             for endpoint in request.form["endpoints"].split(",")
+                             if endpoint.strip()}
+
+                unknown = ", ".join(sorted(endpoints - app.view_functions.keys()))
+                if unknown:
+                    abort(400, f"Unknown endpoint(s): {unknown}")
+
+                app.config["PROFILER_ENDPOINTS"] = endpoints
+
+        return jsonify(pid=os.getpid(),
+                       sample_percent=app.config["PROFILER_SAMPLE_PERCENT"],
+                       endpoints=sorted(app.config["PROFILER_ENDPOINTS"]),
+                       output_dir=app.config["PROFILER_OUTPUT_DIR"],
+                       profiles=app.extensions["request_profiler"].summary())
+
     def __authorize_session_user_to_access(username):
         """
         Determines if the user in the current session is authorized.
@@ -174,12 +336,42 @@ def create_app(db_name, testing=False):
 
         return session_user
 
+    def __authorize_logged_in():
+        """
+        Determines if there is a user in the current session.
+        Raises Unauthorized exception if not, else return session's user's User object.
+        """
+
+        session_username = session.get("username", None)
+        session_user = db.session.get(
+            User, session_username) if session_username else None
+
+        if not session_user:
+            raise Unauthorized()
+
+        return session_user
+
+    def __authorize_admin():
+        """
+        Determines if the user in the current session is an admin.
+        Raises Unauthorized exception if not, else return session's user's User object.
+        """
+
+        session_username = session.get("username", None)
+        session_user = db.session.get(
+            User, session_username) if session_username else None
+
+        if not session_user or not session_user.is_admin:
+            raise Unauthorized()
+
+        return session_user
+
     return app
 
 # ==================================================
 
 
 if __name__ == "__main__":
-    app = create_app("feedback")
+    app = create_app(os.environ.get("DATABASE_URI", "feedback"))
     connect_db(app)
     app.run(debug=True)
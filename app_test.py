@@ -1,14 +1,28 @@
-from types import MappingProxyType
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from types import MappingProxyType, SimpleNamespace
 from unittest import TestCase
+from unittest.mock import patch
 
 from flask import session
+from sqlalchemy import event
 
 from app import create_app
-from models import Feedback, User, connect_db, db
+from compress_feedbacks import migrate
+from models import (SQLITE_PRAGMAS, Feedback, FeedbackRevision, User,
+                    add_missing_columns, connect_db, db)
+from request_profiler import RequestProfiler
+from revision_writer import RevisionWriter
 
 # ==================================================
 
-app = create_app("feedback_test", testing=True)
+# Runs against an embedded SQLite database, unless another database is given.
+app = create_app(os.environ.get("TEST_DATABASE_URI", "sqlite:///feedback_test.db"),
+                 testing=True)
 app.config['WTF_CSRF_ENABLED'] = False
 connect_db(app)
 
@@ -376,3 +390,822 @@ class AddFeedbackTestCase(TestCase):
         self.assertEqual(feedback.content, new_feedback_data["content"])
         self.assertEqual(feedback.username, data1["username"])
         self.assertIsInstance(feedback.id, int)
+
+    def test_add_and_update_feedback_statements(self):
+        """Tests that adding and updating a feedback do not reload it after commit."""
+
+        # Arrange
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement.split()[0])
+
+        event.listen(db.engine, "before_cursor_execute", record_statement)
+        self.addCleanup(event.remove, db.engine,
+                        "before_cursor_execute", record_statement)
+
+        # Act
+        feedback = Feedback.add("feedback1", "abcd", data1["username"])
+        add_statements = list(statements)
+
+        # Loaded like the update route does, before the update.
+        db.session.expire_all()
+        feedback = db.session.get(Feedback, feedback.id)
+        statements.clear()
+        feedback.update("feedback2", "efgh")
+
+        # Assert
+        self.assertEqual(add_statements, ["INSERT"])
+        self.assertEqual(statements, ["UPDATE"])
+
+    def test_add_feedback_compressed(self):
+        """Tests that long feedback content is compressed, and read back unchanged."""
+
+        # Arrange
+        app.config["FEEDBACK_COMPRESSION_THRESHOLD"] = 100
+        self.addCleanup(app.config.__setitem__,
+                        "FEEDBACK_COMPRESSION_THRESHOLD", None)
+
+        url = f"/users/{data1["username"]}/feedback/add"
+        new_feedback_data = MappingProxyType(
+            {"title": "feedback1", "content": "abcd" * 1000})
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["username"] = data1["username"]
+
+        # Act
+            client.post(url, data=new_feedback_data)
+            resp = client.get(f"/users/{data1["username"]}")
+            html = resp.get_data(as_text=True)
+
+        # Assert
+        self.assertIn(new_feedback_data["content"], html)
+
+        feedback = db.session.query(Feedback).filter_by(
+            title=new_feedback_data["title"]).one()
+        self.assertEqual(feedback.content, new_feedback_data["content"])
+        self.assertIsNotNone(feedback.content_compressed)
+        self.assertLess(len(feedback.content_compressed),
+                        len(new_feedback_data["content"]))
+
+
+class SchemaUpgradeTestCase(TestCase):
+    """Tests upgrading tables created before columns were added to the models."""
+
+    @classmethod
+    def setUpClass(cls):
+        db.session.query(User).delete()
+
+        with app.test_client() as client:
+            client.post("/register", data=dict(data1))
+
+    def setUp(self):
+        db.session.query(Feedback).delete()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_add_missing_columns(self):
+        """Tests that a column missing from an existing table is added."""
+
+        # Arrange
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql(
+                "ALTER TABLE feedbacks DROP COLUMN content_compressed")
+
+        # Act
+        add_missing_columns()
+
+        # Assert
+        feedback = Feedback.add("feedback1", "abcd", data1["username"])
+        self.assertIsNone(feedback.content_compressed)
+        self.assertEqual(db.session.query(Feedback).count(), 1)
+
+
+class DatabaseConfigTestCase(TestCase):
+    """Tests the database URI and connection settings."""
+
+    def test_full_uri(self):
+        """Tests that a full database URI is used as given."""
+
+        # Arrange
+        uri = "sqlite:////var/lib/feedback/feedback.db"
+
+        # Act
+        uri_app = create_app(uri, testing=True)
+
+        # Assert
+        self.assertEqual(uri_app.config["SQLALCHEMY_DATABASE_URI"], uri)
+
+    def test_database_name(self):
+        """Tests that a database name is expanded to a local PostgreSQL URI."""
+
+        # Arrange
+        db_name = "feedback"
+
+        # Act
+        name_app = create_app(db_name, testing=True)
+
+        # Assert
+        self.assertEqual(name_app.config["SQLALCHEMY_DATABASE_URI"],
+                         "postgresql://postgres@localhost/feedback")
+        self.assertNotIn("SQLALCHEMY_ENGINE_OPTIONS", name_app.config)
+
+    def test_sqlite_pragmas(self):
+        """Tests that SQLite connections get SQLITE_PRAGMAS."""
+
+        if db.engine.dialect.name != "sqlite":
+            self.skipTest("Needs an SQLite database.")
+
+        # Arrange
+        expected = {"journal_mode": "wal", "synchronous": 1,
+                    "mmap_size": SQLITE_PRAGMAS["mmap_size"],
+                    "busy_timeout": SQLITE_PRAGMAS["busy_timeout"], "foreign_keys": 1}
+
+        # Act
+        with db.engine.connect() as connection:
+            values = {pragma: connection.exec_driver_sql(f"PRAGMA {pragma}").scalar()
+                      for pragma in SQLITE_PRAGMAS}
+
+        # Assert
+        self.assertEqual(values, expected)
+
+
+class MigrateCompressionTestCase(TestCase):
+    """Tests migrating existing feedbacks to or from compressed content storage."""
+
+    @classmethod
+    def setUpClass(cls):
+        db.session.query(User).delete()
+
+        with app.test_client() as client:
+            client.post("/register", data=dict(data1))
+
+    def setUp(self):
+        # Revisions from other tests may still be buffered.
+        app.extensions["revision_writer"].flush()
+
+        db.session.query(Feedback).delete()
+        db.session.query(FeedbackRevision).delete()
+        db.session.commit()
+
+        self.short_content = "abcd"
+        self.long_content = "feedback " * 100
+
+        # Stored uncompressed, as before compression was turned on.
+        for i, content in enumerate([self.short_content, self.long_content]):
+            Feedback.add(f"feedback{i}", content, data1["username"])
+        app.extensions["revision_writer"].flush()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config["FEEDBACK_COMPRESSION_THRESHOLD"] = None
+
+    def get_stored(self, model):
+        """Returns (content, is_compressed) of the model's rows, by content."""
+
+        db.session.expire_all()
+        return sorted((row.content, row.content_compressed is not None)
+                      for row in db.session.query(model))
+
+    def test_migrate_compress(self):
+        """Tests that only content longer than the threshold is compressed."""
+
+        # Arrange
+        threshold = 100
+
+        # Act
+        count = migrate(threshold)
+
+        # Assert
+        self.assertEqual(count, 2)
+        for model in (Feedback, FeedbackRevision):
+            self.assertEqual(self.get_stored(model),
+                             [(self.short_content, False), (self.long_content, True)])
+
+    def test_migrate_raised_threshold(self):
+        """Tests that content no longer over a raised threshold is decompressed."""
+
+        # Arrange
+        migrate(100)
+
+        # Act
+        count = migrate(len(self.long_content))
+
+        # Assert
+        self.assertEqual(count, 2)
+        for model in (Feedback, FeedbackRevision):
+            self.assertEqual(self.get_stored(model),
+                             [(self.short_content, False), (self.long_content, False)])
+
+    def test_migrate_twice(self):
+        """Tests that migrating again with the same threshold changes nothing."""
+
+        # Arrange
+        migrate(100)
+
+        # Act
+        count = migrate(100)
+
+        # Assert
+        self.assertEqual(count, 0)
+
+    def test_migrate_decompress(self):
+        """Tests that a threshold of None decompresses everything."""
+
+        # Arrange
+        migrate(0)
+
+        # Act
+        count = migrate(None)
+
+        # Assert
+        self.assertEqual(count, 4)
+        for model in (Feedback, FeedbackRevision):
+            self.assertEqual(self.get_stored(model),
+                             [(self.short_content, False), (self.long_content, False)])
+
+    def test_migrate_decompress_command(self):
+        """Tests the --decompress command line option."""
+
+        # Arrange
+        migrate(0)
+        db.session.commit()
+        command = [sys.executable, "compress_feedbacks.py",
+                   app.config["SQLALCHEMY_DATABASE_URI"], "--decompress"]
+
+        # Act
+        result = subprocess.run(command, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        # Assert
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Migrated 4 feedback(s) and revision(s).", result.stdout)
+        for model in (Feedback, FeedbackRevision):
+            self.assertEqual(self.get_stored(model),
+                             [(self.short_content, False), (self.long_content, False)])
+
+
+class FeedbackHistoryTestCase(TestCase):
+    """Tests feedback edit history."""
+
+    @classmethod
+    def setUpClass(cls):
+        db.session.query(User).delete()
+
+        with app.test_client() as client:
+            client.post("/register", data=dict(data1))
+
+    def setUp(self):
+        # Revisions from other tests may still be buffered.
+        app.extensions["revision_writer"].flush()
+
+        db.session.query(Feedback).delete()
+        db.session.query(FeedbackRevision).delete()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_feedback_history(self):
+        """Tests that adding, updating, and deleting a feedback is recorded."""
+
+        # Arrange
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["username"] = data1["username"]
+
+            client.post(f"/users/{data1["username"]}/feedback/add",
+                        data={"title": "feedback1", "content": "abcd"})
+            feedback_id = db.session.query(Feedback.id).scalar()
+
+            client.post(f"/feedback/{feedback_id}/update",
+                        data={"title": "feedback2", "content": "efgh"})
+            client.post(f"/feedback/{feedback_id}/delete")
+
+            url = f"/feedback/{feedback_id}/history"
+
+        # Act
+            resp = client.get(url)
+            html = resp.get_data(as_text=True)
+
+        # Assert
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("<h1>Feedback History</h1>", html)
+        self.assertIn("feedback1", html)
+        self.assertIn("feedback2", html)
+
+        actions = [revision.action
+                   for revision in FeedbackRevision.history(feedback_id)]
+        self.assertEqual(actions, ["add", "update", "delete"])
+
+    def test_feedback_history_compressed(self):
+        """Tests that revisions of long content are stored compressed too."""
+
+        # Arrange
+        app.config["FEEDBACK_COMPRESSION_THRESHOLD"] = 100
+        self.addCleanup(app.config.__setitem__,
+                        "FEEDBACK_COMPRESSION_THRESHOLD", None)
+        content = "abcd" * 1000
+
+        # Act
+        feedback = Feedback.add("feedback1", content, data1["username"])
+        app.extensions["revision_writer"].flush()
+
+        # Assert
+        revision, = FeedbackRevision.history(feedback.id)
+        self.assertEqual(revision.content, content)
+        self.assertIsNotNone(revision.content_compressed)
+        self.assertLess(len(revision.content_compressed), len(content))
+
+    def test_feedback_history_with_different_logged_in_user(self):
+        """Users should not be able to see the history of another user's feedback."""
+
+        # Arrange
+        feedback = Feedback.add("feedback1", "abcd", data1["username"])
+        url = f"/feedback/{feedback.id}/history"
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["username"] = "user2"
+
+        # Act
+            resp = client.get(url)
+
+        # Assert
+        self.assertEqual(resp.status_code, 401)
+
+    def test_feedback_history_not_logged_in(self):
+        """Tests that anonymous users cannot make the writer flush, or probe ids."""
+
+        # Arrange
+        feedback = Feedback.add("feedback1", "abcd", data1["username"])
+        urls = [f"/feedback/{feedback.id}/history", "/feedback/99999/history"]
+
+        for url in urls:
+            with self.subTest(url):
+
+        # Act
+                with patch.object(app.extensions["revision_writer"],
+                                  "flush") as flush:
+                    with app.test_client() as client:
+                        resp = client.get(url)
+
+        # Assert
+                self.assertEqual(resp.status_code, 401)
+                flush.assert_not_called()
+
+    def test_feedback_history_when_flush_fails(self):
+        """Tests that stored revisions are shown when buffered ones cannot be written."""
+
+        # Arrange
+        feedback = Feedback.add("feedback1", "abcd", data1["username"])
+        app.extensions["revision_writer"].flush()
+        url = f"/feedback/{feedback.id}/history"
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["username"] = data1["username"]
+
+        # Act
+            with patch.object(app.extensions["revision_writer"], "flush",
+                              side_effect=RuntimeError()):
+                resp = client.get(url)
+                html = resp.get_data(as_text=True)
+
+        # Assert
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("feedback1", html)
+
+
+class RevisionWriterTestCase(TestCase):
+    """Tests the buffered writing of feedback revisions."""
+
+    def setUp(self):
+        app.extensions["revision_writer"].flush()
+
+        db.session.query(FeedbackRevision).delete()
+        # Commit, so that the writers' own connections are not blocked.
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def make_writer(self, **config):
+        """
+        Returns a RevisionWriter that is closed after the test.
+        Sets the given REVISION_* settings, without the prefix, until then.  They
+        are set after the writer is created, as settings are read when used.
+        """
+
+        writer = RevisionWriter(app)
+        self.addCleanup(writer.close)
+
+        for name, value in config.items():
+            key = f"REVISION_{name.upper()}"
+            self.addCleanup(app.config.__setitem__, key, app.config[key])
+            app.config[key] = value
+
+        return writer
+
+    def make_revision(self, **values):
+        """Returns a revision row."""
+
+        return {"feedback_id": 1,
+                "username": data1["username"],
+                "action": "add",
+                "title": "feedback1",
+                "_content": "abcd",
+                "created_at": datetime.now(timezone.utc),
+                **values}
+
+    def count_revisions(self):
+        """Returns the number of revisions inserted by any connection."""
+
+        # End this session's transaction, to see the writers' commits.
+        db.session.commit()
+
+        return db.session.query(FeedbackRevision).count()
+
+    def wait_for_revisions(self, count, timeout=5):
+        """Waits until count revisions are inserted, or timeout seconds pass."""
+
+        deadline = time.monotonic() + timeout
+
+        while self.count_revisions() < count and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        return self.count_revisions()
+
+    def test_flush_when_batch_is_full(self):
+        """Tests that a batch is written once batch_size revisions are buffered."""
+
+        # Arrange
+        writer = self.make_writer(batch_size=2, flush_interval=60)
+        writer.append(self.make_revision())
+        time.sleep(0.2)
+        self.assertEqual(self.count_revisions(), 0)
+
+        # Act
+        writer.append(self.make_revision())
+
+        # Assert
+        self.assertEqual(self.wait_for_revisions(2), 2)
+
+    def test_flush_after_interval(self):
+        """Tests that a partial batch is written after flush_interval seconds."""
+
+        # Arrange
+        writer = self.make_writer(batch_size=100, flush_interval=0.1)
+
+        # Act
+        writer.append(self.make_revision())
+
+        # Assert
+        self.assertEqual(self.wait_for_revisions(1), 1)
+
+    def test_close(self):
+        """Tests that closing writes what is still buffered, and stops appends."""
+
+        # Arrange
+        writer = self.make_writer(batch_size=100, flush_interval=60)
+        writer.append(self.make_revision())
+        writer.append(self.make_revision())
+
+        # Act
+        writer.close()
+
+        # Assert
+        self.assertEqual(self.count_revisions(), 2)
+
+        with self.assertRaises(RuntimeError):
+            writer.append(self.make_revision())
+
+    def test_retry_short_outage(self):
+        """Tests that revisions survive a short outage, with retries on a timer."""
+
+        # Arrange
+        writer = self.make_writer(batch_size=5, flush_interval=0.05,
+                                  retry_interval=0.1, give_up_after=300)
+        insert = writer._insert
+        outage_end = time.monotonic() + 0.4
+        failed_inserts = []
+
+        def flaky_insert(rows):
+            if time.monotonic() < outage_end:
+                failed_inserts.append(rows)
+                raise RuntimeError("Database is unavailable.")
+            insert(rows)
+
+        # Act
+        with patch.object(writer, "_insert", side_effect=flaky_insert):
+            with self.assertLogs(app.logger, "ERROR") as logs:
+                for i in range(12):
+                    writer.append(self.make_revision(title=f"feedback{i}"))
+                    time.sleep(0.02)
+
+                count = self.wait_for_revisions(12)
+
+        # Assert
+        self.assertEqual(count, 12)
+        self.assertFalse([line for line in logs.output if "Dropped" in line])
+        # Retries wait 0.1, 0.2, then 0.4 seconds, whatever is appended meanwhile.
+        self.assertLessEqual(len(failed_inserts), 4)
+
+    def test_give_up_on_bad_revision(self):
+        """Tests that only the revision that cannot be inserted is given up on."""
+
+        # Arrange
+        writer = self.make_writer(batch_size=5, flush_interval=60,
+                                  give_up_after=0)
+        for title in ("feedback1", "feedback2", None, "feedback3", "feedback4"):
+            writer.append(self.make_revision(title=title))
+
+        # Act
+        with self.assertLogs(app.logger, "ERROR") as logs:
+            inserted = writer.flush()
+
+        # Assert
+        self.assertEqual(inserted, 4)
+        self.assertEqual(self.count_revisions(), 4)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("Dropped feedback revision", logs.output[0])
+
+    def test_max_buffer_size(self):
+        """Tests that the oldest revision is logged and dropped when the buffer is full."""
+
+        # Arrange
+        writer = self.make_writer(batch_size=100, flush_interval=60,
+                                  max_buffer_size=2)
+
+        # Act
+        with self.assertLogs(app.logger, "ERROR") as logs:
+            for title in ("feedback1", "feedback2", "feedback3"):
+                writer.append(self.make_revision(title=title))
+
+        writer.flush()
+
+        # Assert
+        self.assertIn("feedback1", logs.output[0])
+
+        titles = [title for title, in db.session.query(FeedbackRevision.title)]
+        self.assertEqual(sorted(titles), ["feedback2", "feedback3"])
+
+
+class FeedbackEventsTestCase(TestCase):
+    """Tests the admin stream of feedback events."""
+
+    @classmethod
+    def setUpClass(cls):
+        db.session.query(User).delete()
+
+        with app.test_client() as client:
+            client.post("/register", data=dict(data1))
+
+    def setUp(self):
+        db.session.query(Feedback).delete()
+        db.session.query(User).update({"is_admin": False})
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_feedback_events(self):
+        """Tests that an admin is sent an event when a feedback is added."""
+
+        # Arrange
+        user = db.session.get(User, data1["username"])
+        user.is_admin = True
+        db.session.commit()
+
+        url = "/admin/feedback/events"
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["username"] = data1["username"]
+
+            resp = client.get(url, buffered=False)
+            stream = iter(resp.response)
+            next(stream)
+
+        # Act
+            feedback = Feedback.add("feedback1", "abcd", data1["username"])
+            chunk = next(stream).decode()
+            resp.close()
+
+        # Assert
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        self.assertIn("event: feedback", chunk)
+        self.assertIn(f'"id": {feedback.id}', chunk)
+        self.assertIn('"action": "add"', chunk)
+
+    def test_feedback_events_publish_fails(self):
+        """Tests that a change is still saved when its event cannot be published."""
+
+        # Arrange
+        hub = app.extensions["feedback_events"]
+
+        # Act
+        with patch.object(hub, "publish", side_effect=RuntimeError()):
+            with self.assertLogs(app.logger, "ERROR"):
+                Feedback.add("feedback1", "abcd", data1["username"])
+
+        # Assert
+        self.assertEqual(db.session.query(Feedback).count(), 1)
+
+    def test_feedback_events_not_admin(self):
+        """Non-admin users should not be able to see the events stream."""
+
+        # Arrange
+        url = "/admin/feedback/events"
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["username"] = data1["username"]
+
+        # Act
+            resp = client.get(url)
+
+        # Assert
+        self.assertEqual(resp.status_code, 401)
+
+
+class ProfilerTestCase(TestCase):
+    """Tests profiling requests."""
+
+    @classmethod
+    def setUpClass(cls):
+        db.session.query(User).delete()
+
+        with app.test_client() as client:
+            client.post("/register", data=dict(data1))
+
+    def setUp(self):
+        db.session.query(User).update({"is_admin": False})
+
+        output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        self.addCleanup(app.config.__setitem__, "PROFILER_OUTPUT_DIR",
+                        app.config["PROFILER_OUTPUT_DIR"])
+        app.config["PROFILER_OUTPUT_DIR"] = output_dir.name
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config["PROFILER_ENDPOINTS"] = set()
+
+    def test_profile_endpoint(self):
+        """Tests that an admin can turn on profiling for an endpoint."""
+
+        # Arrange
+        user = db.session.get(User, data1["username"])
+        user.is_admin = True
+        db.session.commit()
+
+        url = "/admin/profiler"
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["username"] = data1["username"]
+
+        # Act
+            resp = client.post(url, data={"endpoints": "user_profile"})
+            client.get(f"/users/{data1["username"]}")
+
+        # Assert
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["endpoints"], ["user_profile"])
+
+        profiler = app.extensions["request_profiler"]
+        self.assertGreaterEqual(profiler.summary()["user_profile"]["requests"], 1)
+
+        profiler.write()
+        self.assertEqual(resp.json["pid"], os.getpid())
+        self.assertTrue(os.path.exists(os.path.join(
+            app.config["PROFILER_OUTPUT_DIR"], f"user_profile.{os.getpid()}.folded")))
+
+    def test_profiles_written_periodically(self):
+        """Tests that profiles are written without an explicit write."""
+
+        # Arrange
+        self.addCleanup(app.config.__setitem__, "PROFILER_WRITE_INTERVAL",
+                        app.config["PROFILER_WRITE_INTERVAL"])
+        app.config["PROFILER_WRITE_INTERVAL"] = 0.1
+        app.config["PROFILER_ENDPOINTS"] = {"user_profile"}
+
+        path = os.path.join(app.config["PROFILER_OUTPUT_DIR"],
+                            f"user_profile.{os.getpid()}.json")
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["username"] = data1["username"]
+
+        # Act
+            client.get(f"/users/{data1["username"]}")
+
+        # Assert
+        deadline = time.monotonic() + 5
+        while not os.path.exists(path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        self.assertTrue(os.path.exists(path))
+
+    def test_profile_login_categories(self):
+        """Tests that a profiled login attributes time to bcrypt separately."""
+
+        # Arrange
+        app.config["PROFILER_ENDPOINTS"] = {"login_user"}
+        data = {"username": data1["username"], "password": data1["password"]}
+
+        # Act
+        with app.test_client() as client:
+            client.post("/login", data=data)
+
+        profiler = app.extensions["request_profiler"]
+        profiler.write()
+
+        # Assert
+        self.assertGreater(profiler.summary()["login_user"]["bcrypt_ms"], 0)
+
+        with open(os.path.join(app.config["PROFILER_OUTPUT_DIR"],
+                               f"login_user.{os.getpid()}.folded")) as file:
+            folded = file.read()
+        self.assertIn(";[bcrypt];", folded)
+
+    def test_fold_categories(self):
+        """Tests that stacks entering SQL or bcrypt code are tagged with their category."""
+
+        # Arrange
+        def make_stack(*names):
+            frame = None
+            for name in names:
+                module, _, qualname = name.partition(":")
+                frame = SimpleNamespace(f_globals={"__name__": module},
+                                        f_code=SimpleNamespace(co_qualname=qualname),
+                                        f_back=frame)
+            return frame
+
+        stacks = {
+            "sql": make_stack("app:user_profile", "sqlalchemy.orm.session:Session.get",
+                              "sqlalchemy.engine.base:Connection.execute"),
+            "bcrypt": make_stack("app:login_user", "models:User.authenticate",
+                                 "flask_bcrypt:Bcrypt.check_password_hash"),
+            "app": make_stack("app:user_profile", "flask.templating:render_template"),
+        }
+
+        for expected_category, frame in stacks.items():
+            with self.subTest(expected_category):
+
+        # Act
+                stack, category = RequestProfiler._fold("endpoint", frame)
+
+        # Assert
+                self.assertEqual(category, expected_category)
+
+                if expected_category == "sql":
+                    self.assertEqual(stack, "endpoint;app:user_profile;"
+                                     "sqlalchemy.orm.session:Session.get;[sql];"
+                                     "sqlalchemy.engine.base:Connection.execute")
+                elif expected_category == "bcrypt":
+                    self.assertIn("models:User.authenticate;[bcrypt];flask_bcrypt:",
+                                  stack)
+                else:
+                    self.assertNotIn("[", stack)
+
+    def test_profile_unknown_endpoint(self):
+        """Tests that profiling an endpoint that does not exist is rejected."""
+
+        # Arrange
+        user = db.session.get(User, data1["username"])
+        user.is_admin = True
+        db.session.commit()
+
+        url = "/admin/profiler"
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["username"] = data1["username"]
+
+        # Act
+            resp = client.post(url, data={"endpoints": "random"})
+
+        # Assert
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(app.config["PROFILER_ENDPOINTS"], set())
+
+    def test_profiler_not_admin(self):
+        """Non-admin users should not be able to change profiling."""
+
+        # Arrange
+        url = "/admin/profiler"
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["username"] = data1["username"]
+
+        # Act
+            resp = client.post(url, data={"sample_percent": "100"})
+
+        # Assert
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(app.config["PROFILER_SAMPLE_PERCENT"], 0)
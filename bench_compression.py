@@ -0,0 +1,136 @@
+"""
+Benchmarks the size of the feedbacks and feedback_revisions tables and the user
+profile page latency, before and after migrating to compressed content storage.
+
+Drops and recreates all tables, so point it at a scratch database.
+
+Usage:
+    python bench_compression.py <db_name> [--feedbacks N] [--size CHARS]
+                                          [--threshold CHARS] [--requests N]
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from app import create_app
+from compress_feedbacks import migrate
+from models import Feedback, User, connect_db, db
+
+# ==================================================
+
+WORDS = ("the", "feedback", "page", "slow", "error", "login", "profile", "user",
+         "button", "when", "click", "after", "again", "please", "fix", "log")
+
+
+def make_content(size):
+    """Returns text of about size characters, like a pasted log or report."""
+
+    words = []
+    length = 0
+
+    while length < size:
+        word = random.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+
+    return " ".join(words)[:size]
+
+
+def table_size():
+    """
+    Returns the size in bytes of the feedbacks and feedback_revisions tables, or
+    None if unsupported.
+    """
+
+    dialect = db.engine.dialect.name
+
+    if dialect not in ("postgresql", "sqlite"):
+        return None
+
+    # Reclaim the rows left behind by the migration's updates.
+    with db.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT") as connection:
+        if dialect == "postgresql":
+            connection.exec_driver_sql("VACUUM FULL feedbacks, feedback_revisions")
+            return connection.exec_driver_sql(
+                "SELECT pg_total_relation_size('feedbacks') "
+                "+ pg_total_relation_size('feedback_revisions')").scalar()
+        else:
+            connection.exec_driver_sql("VACUUM")
+            return connection.exec_driver_sql(
+                "SELECT SUM(pgsize) FROM dbstat "
+                "WHERE name IN ('feedbacks', 'feedback_revisions')").scalar()
+
+
+def profile_latency(app, username, requests):
+    """Returns the median latency in milliseconds of the user's profile page."""
+
+    timings = []
+
+    with app.test_client() as client:
+        with client.session_transaction() as change_session:
+            change_session["username"] = username
+
+        for _ in range(requests):
+            start = time.perf_counter()
+            resp = client.get(f"/users/{username}")
+            timings.append((time.perf_counter() - start) * 1000)
+
+            assert resp.status_code == 200
+
+    return statistics.median(timings)
+
+
+def report(label, size, latency):
+    """Prints one line of results."""
+
+    size = "n/a" if size is None else f"{size / 1024:,.0f} KiB"
+    print(f"{label:<8} table size: {size:>12}   profile page: {latency:8.2f} ms")
+
+
+# ==================================================
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("db_name")
+    parser.add_argument("--feedbacks", type=int, default=200)
+    parser.add_argument("--size", type=int, default=100_000)
+    parser.add_argument("--threshold", type=int, default=1024)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    app = create_app(args.db_name, testing=True)
+    connect_db(app)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        user = User(username="benchuser", password="x", email="bench@email.com",
+                    first_name="bench", last_name="bench")
+        db.session.add(user)
+        db.session.commit()
+
+        # Added one by one, so that each also gets a revision.
+        for i in range(args.feedbacks):
+            Feedback.add(f"feedback{i}", make_content(args.size), user.username)
+        app.extensions["revision_writer"].flush()
+
+        size_before = table_size()
+
+    # Outside of an app context, so every request loads the profile from scratch.
+    latency_before = profile_latency(app, "benchuser", args.requests)
+
+    with app.app_context():
+        migrate(args.threshold)
+        app.config["FEEDBACK_COMPRESSION_THRESHOLD"] = args.threshold
+
+        size_after = table_size()
+
+    latency_after = profile_latency(app, "benchuser", args.requests)
+
+    report("before", size_before, latency_before)
+    report("after", size_after, latency_after)
@@ -0,0 +1,89 @@
+"""
+Migrates existing feedbacks and their revisions to or from compressed content
+storage.
+
+Usage:
+    python compress_feedbacks.py <db_name> <threshold>
+    python compress_feedbacks.py <db_name> --decompress
+"""
+
+import argparse
+
+from app import create_app
+from models import (Feedback, FeedbackRevision, compress_content, connect_db,
+                    db, decompress_content)
+
+# ==================================================
+
+
+def migrate(threshold, batch_size=500):
+    """
+    Stores existing feedbacks and feedback revisions the way Feedback would store
+    them with the given FEEDBACK_COMPRESSION_THRESHOLD.  A threshold of None
+    decompresses everything.
+    Returns the number of rows changed.
+    """
+
+    return sum(migrate_table(model.__table__, threshold, batch_size)
+               for model in (Feedback, FeedbackRevision))
+
+
+def migrate_table(table, threshold, batch_size):
+    """Migrates the content of one table.  Returns the number of rows changed."""
+
+    # Compressed rows are always checked, since their content may be short enough
+    # to store uncompressed under a raised threshold.
+    candidates = table.c.content_compressed.is_not(None)
+    if threshold is not None:
+        candidates = db.or_(candidates,
+                            db.func.length(table.c.content) > threshold)
+
+    changed = 0
+    last_id = 0
+
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(
+                db.select(table.c.id, table.c.content, table.c.content_compressed)
+                .where(candidates, table.c.id > last_id)
+                .order_by(table.c.id)
+                .limit(batch_size)).all()
+
+            if not rows:
+                return changed
+
+            for row_id, content, content_compressed in rows:
+                new_content, new_compressed = compress_content(
+                    decompress_content(content, content_compressed), threshold)
+
+                # Compressed rows that stay compressed are left as they are.
+                if (new_compressed is None) == (content_compressed is None):
+                    continue
+
+                connection.execute(
+                    db.update(table)
+                    .where(table.c.id == row_id)
+                    .values(content=new_content, content_compressed=new_compressed))
+                changed += 1
+
+            last_id = rows[-1].id
+
+
+# ==================================================
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("db_name")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("threshold", nargs="?", type=int)
+    group.add_argument("--decompress", action="store_true")
+    args = parser.parse_args()
+
+    app = create_app(args.db_name)
+    connect_db(app)
+
+    with app.app_context():
+        count = migrate(None if args.decompress else args.threshold)
+
+    print(f"Migrated {count} feedback(s) and revision(s).")
@@ -0,0 +1,137 @@
+"""Publish/subscribe hub for feedback changes."""
+
+import json
+import queue
+import select
+import threading
+import time
+
+from models import db
+
+# ==================================================
+
+
+class FeedbackEventHub:
+    """
+    Fans out events about committed feedback changes to subscribers, such as the
+    admin server-sent events stream.
+
+    By default, events only reach subscribers in the same process.  With
+    FEEDBACK_EVENTS_PG_NOTIFY set and a PostgreSQL database, events are sent with
+    NOTIFY instead, and every process that has subscribers runs a thread that
+    LISTENs and hands the events to them, so admins see changes made by any worker.
+    """
+
+    CHANNEL = "feedback_events"
+
+    def __init__(self, app, max_queue_size=100):
+        self.app = app
+        self.max_queue_size = max_queue_size
+
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def uses_notify(self):
+        """Returns whether events go through PostgreSQL NOTIFY."""
+
+        return (self.app.config["FEEDBACK_EVENTS_PG_NOTIFY"]
+                and self.app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgresql"))
+
+    def publish(self, event):
+        """Publishes an event, given as a JSON-serializable dict."""
+
+        if self.uses_notify():
+            with db.engine.begin() as connection:
+                connection.execute(
+                    db.select(db.func.pg_notify(self.CHANNEL, json.dumps(event))))
+        else:
+            self._deliver(event)
+
+    def subscribe(self):
+        """Returns a new queue that receives every event published from now on."""
+
+        subscription = queue.Queue(self.max_queue_size)
+
+        with self._lock:
+            self._subscribers.add(subscription)
+
+            if self.uses_notify() and not self._listener:
+                self._listener = threading.Thread(
+                    target=self._listen, name="feedback-events-listener", daemon=True)
+                self._listener.start()
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stops a queue from receiving events."""
+
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def stream(self, keepalive=15):
+        """
+        Generates a server-sent events stream of published events.
+        Sends a comment every keepalive seconds without events, so that proxies
+        keep the connection open and disconnected clients are noticed.
+        """
+
+        subscription = self.subscribe()
+
+        try:
+            yield "retry: 5000\n\n"
+
+            while True:
+                try:
+                    event = subscription.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                else:
+                    yield f"event: feedback\ndata: {json.dumps(event)}\n\n"
+        finally:
+            self.unsubscribe(subscription)
+
+    def _deliver(self, event):
+        """Puts an event on every subscriber's queue."""
+
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            # A slow subscriber loses its oldest event rather than block publishers.
+            while True:
+                try:
+                    subscription.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        subscription.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def _listen(self):
+        """Background loop that delivers NOTIFY events, reconnecting on errors."""
+
+        while True:
+            try:
+                with self.app.app_context():
+                    connection = db.engine.raw_connection()
+
+                try:
+                    connection.dbapi_connection.autocommit = True
+                    cursor = connection.cursor()
+                    cursor.execute(f"LISTEN {self.CHANNEL}")
+
+                    pg_connection = connection.dbapi_connection
+                    while True:
+                        select.select([pg_connection], [], [], 5)
+                        pg_connection.poll()
+
+                        while pg_connection.notifies:
+                            notify = pg_connection.notifies.pop(0)
+                            self._deliver(json.loads(notify.payload))
+                finally:
+                    connection.invalidate()
+            except Exception:
+                self.app.logger.exception("Feedback events listener failed.")
+                time.sleep(1)
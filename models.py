@@ -1,7 +1,12 @@
 """Models for feedback app."""
 
+import zlib
+from datetime import datetime, timezone
+
+from flask import current_app
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
 from sqlalchemy.exc import IntegrityError
 
 # ==================================================
@@ -9,16 +14,103 @@ from sqlalchemy.exc import IntegrityError
 db = SQLAlchemy()
 bcrypt = Bcrypt()
 
+# Applied to every new SQLite connection, for a single node serving the app.
+SQLITE_PRAGMAS = {
+    # Readers do not block the writer, and the writer does not block readers.
+    "journal_mode": "WAL",
+    # Safe with WAL; only the last commits can be lost on power failure.
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    # Milliseconds to wait for another connection's write lock.
+    "busy_timeout": 5000,
+    # Needed for ON DELETE CASCADE.
+    "foreign_keys": "ON",
+}
+
 # --------------------------------------------------
 
 
+def compress_content(content, threshold):
+    """
+    Decides how feedback content is stored.
+    Returns a tuple of (text, compressed bytes).  Content longer than threshold
+    characters is zlib-compressed and its text is left empty; otherwise, or if
+    threshold is None, the compressed bytes are None.
+    """
+
+    if threshold is None or len(content) <= threshold:
+        return content, None
+
+    return "", zlib.compress(content.encode("utf8"))
+
+
+def decompress_content(content, content_compressed):
+    """Reverses compress_content, returning the original content."""
+
+    if content_compressed is None:
+        return content
+
+    return zlib.decompress(content_compressed).decode("utf8")
+
+
+def publish_feedback_event(feedback_event):
+    """
+    Publishes a feedback event through the app's event hub, if it has one.
+    Failures are logged instead of raised, since the change is already committed.
+    """
+
+    hub = current_app.extensions.get("feedback_events")
+
+    if hub:
+        try:
+            hub.publish(feedback_event)
+        except Exception:
+            current_app.logger.exception("Failed to publish feedback event.")
+
+
 def connect_db(app):
     """Connect to database."""
 
     with app.app_context():
         db.app = app
         db.init_app(app)
+
+        if db.engine.dialect.name == "sqlite":
+            event.listen(db.engine, "connect", configure_sqlite_connection)
+
         db.create_all()
+        add_missing_columns()
+
+
+def add_missing_columns():
+    """
+    Adds columns that were added to the models after their tables were created,
+    such as feedbacks.content_compressed, since create_all only creates missing
+    tables.  Only nullable columns are added, since existing rows have no value.
+    """
+
+    inspector = inspect(db.engine)
+
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column["name"]
+                        for column in inspector.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    connection.exec_driver_sql(
+                        f"ALTER TABLE {table.name} "
+                        f"ADD COLUMN {column.name} {column_type}")
+
+
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """Sets SQLITE_PRAGMAS on a new SQLite connection."""
+
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+    cursor.close()
 
 
 class User(db.Model):
@@ -91,24 +183,56 @@ class User(db.Model):
     def delete(self):
         """Deletes a user from the database."""
 
+        feedback_events = [feedback.event("delete") for feedback in self.feedbacks]
+        revisions = [FeedbackRevision.snapshot(feedback, "delete")
+                     for feedback in self.feedbacks]
+
         db.session.delete(self)
         db.session.commit()
 
+        for revision in revisions:
+            FeedbackRevision.save(revision)
+
+        for feedback_event in feedback_events:
+            publish_feedback_event(feedback_event)
+
 
 class Feedback(db.Model):
     """Feedback model"""
 
     __tablename__ = "feedbacks"
+    # Revisions are looked up by id, so SQLite must not reuse deleted ids.
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
-    content = db.Column(db.Text, nullable=False)
+    # Use the content property instead, which handles compression.
+    _content = db.Column("content", db.Text, nullable=False)
+    content_compressed = db.Column(db.LargeBinary)
     username = db.Column(db.String(20), db.ForeignKey(
         "users.username", ondelete="CASCADE"))
 
     def __repr__(self) -> str:
         return super().__repr__()
 
+    @property
+    def content(self):
+        """Returns the content, decompressing it if needed."""
+
+        return decompress_content(self._content, self.content_compressed)
+
+    @content.setter
+    def content(self, content):
+        """
+        Sets the content.
+        Compresses it if the app has FEEDBACK_COMPRESSION_THRESHOLD set and the
+        content is longer than that.
+        """
+
+        threshold = current_app.config.get("FEEDBACK_COMPRESSION_THRESHOLD")
+        self._content, self.content_compressed = compress_content(
+            content, threshold)
+
     @classmethod
     def add(cls, title, content, username):
         """
@@ -118,8 +242,15 @@ class Feedback(db.Model):
 
         feedback = cls(title=title, content=content, username=username)
         db.session.add(feedback)
+        # Gets the id now, so the snapshot does not have to reload it after commit.
+        db.session.flush()
+        revision = FeedbackRevision.snapshot(feedback, "add")
+        feedback_event = feedback.event("add")
         db.session.commit()
 
+        FeedbackRevision.save(revision)
+        publish_feedback_event(feedback_event)
+
         return feedback
 
     def update(self, title, content):
@@ -130,12 +261,100 @@ class Feedback(db.Model):
 
         self.title = title
         self.content = content
+        revision = FeedbackRevision.snapshot(self, "update")
+        feedback_event = self.event("update")
         db.session.commit()
 
+        FeedbackRevision.save(revision)
+        publish_feedback_event(feedback_event)
+
         return self
 
     def delete(self):
         """Deletes a feedback. """
 
+        feedback_event = self.event("delete")
+        revision = FeedbackRevision.snapshot(self, "delete")
+
         db.session.delete(self)
         db.session.commit()
+
+        FeedbackRevision.save(revision)
+        publish_feedback_event(feedback_event)
+
+    def event(self, action):
+        """Returns a compact description of a change to this feedback."""
+
+        return {"action": action,
+                "id": self.id,
+                "username": self.username,
+                "title": self.title}
+
+
+class FeedbackRevision(db.Model):
+    """
+    Append-only history of feedbacks.
+    Each row is a snapshot of a feedback right after it was added or updated,
+    or right before it was deleted.
+    """
+
+    __tablename__ = "feedback_revisions"
+
+    id = db.Column(db.Integer, primary_key=True)
+    # Not a foreign key, so that history outlives the feedback.
+    feedback_id = db.Column(db.Integer, nullable=False, index=True)
+    username = db.Column(db.String(20), nullable=False)
+    action = db.Column(db.String(10), nullable=False)
+    title = db.Column(db.String(100), nullable=False)
+    # Use the content property instead, which handles compression.
+    _content = db.Column("content", db.Text, nullable=False)
+    content_compressed = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    @classmethod
+    def snapshot(cls, feedback, action):
+        """
+        Takes a snapshot of a feedback, as a dict of column values.
+        Take it before committing, while the feedback's attributes are loaded, so
+        that they are not reloaded from the database.  Content is copied as the
+        feedback stores it, compressed or not.
+        """
+
+        return {"feedback_id": feedback.id,
+                "username": feedback.username,
+                "action": action,
+                "title": feedback.title,
+                "_content": feedback._content,
+                "content_compressed": feedback.content_compressed,
+                "created_at": datetime.now(timezone.utc)}
+
+    @property
+    def content(self):
+        """Returns the content, decompressing it if needed."""
+
+        return decompress_content(self._content, self.content_compressed)
+
+    @classmethod
+    def save(cls, row):
+        """
+        Saves a snapshot after its change is committed.
+        The snapshot is handed to the app's revision writer to be saved in a later
+        batch, or saved immediately if the app does not have a revision writer.
+        """
+
+        writer = current_app.extensions.get("revision_writer")
+
+        if writer:
+            writer.append(row)
+        else:
+            db.session.execute(db.insert(cls), [row])
+            db.session.commit()
+
+    @classmethod
+    def history(cls, feedback_id):
+        """Returns a list of a feedback's revisions, oldest first."""
+
+        return db.session.execute(
+            db.select(cls)
+            .filter_by(feedback_id=feedback_id)
+            .order_by(cls.created_at, cls.id)).scalars().all()
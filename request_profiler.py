@@ -0,0 +1,192 @@
+"""Sampling profiler for live requests."""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+# Samples inside frames from these modules are filed under the category, so that
+# database and password hashing time show up separately from the app's own time.
+CATEGORIES = {
+    # Executing statements and fetching rows.
+    "sql": ("sqlalchemy.engine", "sqlalchemy.pool"),
+    "bcrypt": ("bcrypt", "flask_bcrypt"),
+}
+
+# ==================================================
+
+
+class RequestProfiler:
+    """
+    Profiles chosen requests by sampling their call stack from a background thread
+    every PROFILER_INTERVAL seconds.  Nothing is done for requests not chosen.
+
+    Samples are aggregated per endpoint and written every PROFILER_WRITE_INTERVAL
+    seconds, for endpoints with new requests, to PROFILER_OUTPUT_DIR as
+    <endpoint>.<pid>.folded, in the folded stacks format read by flamegraph.pl and
+    speedscope, and <endpoint>.<pid>.json, with the time spent per category.
+    Stacks entering a category get a [sql] or [bcrypt] frame, and everything else
+    counts as app time.
+
+    Each process has its own profiler, so with several worker processes, each
+    writes its own files, and settings changed in one process's config do not
+    apply to the others.  Folded files of all workers can be concatenated before
+    making a flame graph.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+        # Thread ident of each request being profiled, to its endpoint.
+        self._active = {}
+        self._stacks = {}
+        self._categories = {}
+        self._requests = Counter()
+        self._unwritten = set()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def should_profile(self, endpoint):
+        """Returns whether a request to the endpoint is chosen for profiling."""
+
+        return (endpoint in self.app.config["PROFILER_ENDPOINTS"]
+                or random.uniform(0, 100) < self.app.config["PROFILER_SAMPLE_PERCENT"])
+
+    def start(self, endpoint):
+        """Starts profiling the current thread's request."""
+
+        with self._lock:
+            self._active[threading.get_ident()] = endpoint
+            self._requests[endpoint] += 1
+
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+
+        self._wakeup.set()
+
+    def stop(self):
+        """Stops profiling the current thread's request."""
+
+        with self._lock:
+            endpoint = self._active.pop(threading.get_ident(), None)
+
+            if endpoint:
+                self._unwritten.add(endpoint)
+
+    def summary(self):
+        """Returns the number of requests and milliseconds per category, by endpoint."""
+
+        interval_ms = self.app.config["PROFILER_INTERVAL"] * 1000
+
+        with self._lock:
+            return {endpoint: {"requests": self._requests[endpoint],
+                               **{f"{category}_ms": round(samples * interval_ms, 1)
+                                  for category, samples in self._categories.get(
+                                      endpoint, Counter()).items()}}
+                    for endpoint in self._requests}
+
+    def write(self):
+        """Writes the profiles of endpoints that have new samples."""
+
+        with self._write_lock:
+            summary = self.summary()
+
+            with self._lock:
+                endpoints, self._unwritten = self._unwritten, set()
+                stacks = {endpoint: dict(self._stacks.get(endpoint, {}))
+                          for endpoint in endpoints}
+
+            if not endpoints:
+                return
+
+            output_dir = self.app.config["PROFILER_OUTPUT_DIR"]
+            os.makedirs(output_dir, exist_ok=True)
+
+            for endpoint in endpoints:
+                # Worker processes share the output directory.
+                path = os.path.join(output_dir, f"{endpoint}.{os.getpid()}")
+
+                self._write_file(f"{path}.folded", "".join(
+                    f"{stack} {count}\n" for stack, count in stacks[endpoint].items()))
+                self._write_file(f"{path}.json",
+                                 json.dumps(summary[endpoint], indent=2))
+
+    def _write_file(self, path, text):
+        """Replaces a file's contents, without readers seeing a partial file."""
+
+        with open(f"{path}.tmp", "w") as file:
+            file.write(text)
+
+        os.replace(f"{path}.tmp", path)
+
+    def _run(self):
+        """
+        Background loop that samples profiled requests, and writes every
+        PROFILER_WRITE_INTERVAL seconds whether or not requests are being profiled.
+        """
+
+        last_write = time.monotonic()
+
+        while True:
+            next_write = last_write + self.app.config["PROFILER_WRITE_INTERVAL"]
+
+            if time.monotonic() >= next_write:
+                try:
+                    self.write()
+                except OSError:
+                    self.app.logger.exception("Failed to write request profiles.")
+
+                last_write = time.monotonic()
+                continue
+
+            with self._lock:
+                active = dict(self._active)
+
+            if not active:
+                self._wakeup.wait(next_write - time.monotonic())
+                self._wakeup.clear()
+                continue
+
+            frames = sys._current_frames()
+
+            with self._lock:
+                for ident, endpoint in active.items():
+                    if ident in frames:
+                        stack, category = self._fold(endpoint, frames[ident])
+                        self._stacks.setdefault(endpoint, Counter())[stack] += 1
+                        self._categories.setdefault(
+                            endpoint, Counter())[category] += 1
+
+            del frames
+            time.sleep(self.app.config["PROFILER_INTERVAL"])
+
+    @staticmethod
+    def _fold(endpoint, frame):
+        """
+        Returns a frame's stack as a folded stack line, outermost frame first,
+        and the category of the sample.
+        """
+
+        names = []
+        while frame:
+            module = frame.f_globals.get("__name__", "?")
+            names.append(f"{module}:{frame.f_code.co_qualname}")
+            frame = frame.f_back
+        names.reverse()
+
+        for i, name in enumerate(names):
+            module = name.partition(":")[0]
+
+            for category, prefixes in CATEGORIES.items():
+                if module.startswith(prefixes):
+                    names.insert(i, f"[{category}]")
+                    return ";".join([endpoint, *names]), category
+
+        return ";".join([endpoint, *names]), "app"
@@ -0,0 +1,231 @@
+"""Buffered writer for feedback revisions."""
+
+import atexit
+import threading
+import time
+
+from models import FeedbackRevision, db
+
+# Longest wait between retries of a failing insert, in seconds.
+MAX_RETRY_DELAY = 30
+
+# ==================================================
+
+
+class RevisionWriter:
+    """
+    Collects feedback revisions in memory and inserts them in batches from a
+    background thread, so that requests do not wait on the history insert.
+
+    A batch is written once REVISION_BATCH_SIZE revisions are buffered, or at the
+    latest REVISION_FLUSH_INTERVAL seconds after a revision was buffered.  Each
+    insert is at most REVISION_BATCH_SIZE revisions.
+
+    When an insert fails, the background thread waits REVISION_RETRY_INTERVAL
+    seconds before retrying, doubling on every further failure up to
+    MAX_RETRY_DELAY, and new revisions do not cut the wait short.  A batch is
+    retried for REVISION_GIVE_UP_AFTER seconds.  After that, its revisions are
+    inserted one at a time, and only the ones that still fail are given up on.
+    At most REVISION_MAX_BUFFER_SIZE revisions are buffered, so that a long
+    database outage does not use up memory.
+
+    Anything still buffered is written when close() is called, which is also done
+    at interpreter exit, retrying for up to REVISION_CLOSE_TIMEOUT seconds.
+    Revisions given up on for any reason are logged as errors, with their full
+    contents, so that they can be recovered from the log.
+
+    Settings are read from the app's config when used, so they can be changed
+    after the writer is created.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+        self._buffer = []
+        # When the batch at the front of the buffer first failed to insert.
+        self._failing_since = None
+        # Failed inserts in a row, and when the background thread may retry.
+        self._failures = 0
+        self._retry_at = None
+        self._buffer_lock = threading.Lock()
+        # Serializes flushes, so that batches are inserted in the order buffered.
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+
+        atexit.register(self.close)
+
+    def append(self, row):
+        """Buffers a revision, given as a dict of FeedbackRevision column values."""
+
+        with self._buffer_lock:
+            if self._closed:
+                raise RuntimeError("Revision writer is closed.")
+
+            if len(self._buffer) >= self.app.config["REVISION_MAX_BUFFER_SIZE"]:
+                self._give_up([self._buffer.pop(0)], "buffer is full")
+
+            self._buffer.append(row)
+            is_full = len(self._buffer) >= self.app.config["REVISION_BATCH_SIZE"]
+
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name="revision-writer", daemon=True)
+                self._thread.start()
+
+        if is_full:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Inserts all buffered revisions now, in batches.
+        Returns the number of revisions inserted.  Raises the database's error if
+        a batch fails to insert and stays buffered, or none of it could be saved.
+        """
+
+        inserted = 0
+
+        with self._flush_lock:
+            while True:
+                with self._buffer_lock:
+                    batch = self._buffer[:self.app.config["REVISION_BATCH_SIZE"]]
+                    del self._buffer[:len(batch)]
+
+                if not batch:
+                    return inserted
+
+                try:
+                    self._insert(batch)
+                    batch_inserted = len(batch)
+                except Exception:
+                    batch_inserted = self._handle_failure(batch)
+                    if not batch_inserted:
+                        raise
+
+                self._failing_since = None
+                self._failures = 0
+                self._retry_at = None
+                inserted += batch_inserted
+
+    def close(self):
+        """Stops the background thread and inserts any remaining revisions."""
+
+        with self._buffer_lock:
+            self._closed = True
+            thread = self._thread
+
+        if thread:
+            self._wakeup.set()
+            thread.join()
+
+        deadline = time.monotonic() + self.app.config["REVISION_CLOSE_TIMEOUT"]
+
+        while True:
+            try:
+                self.flush()
+                return
+            except Exception:
+                self.app.logger.exception("Failed to write feedback revisions.")
+
+            now = time.monotonic()
+
+            if now >= deadline:
+                with self._buffer_lock:
+                    rows, self._buffer = self._buffer, []
+
+                self._give_up(rows, "writer closed before they were inserted")
+                return
+
+            time.sleep(min(max((self._retry_at or now) - now, 0), deadline - now))
+
+    def _insert(self, rows):
+        """Inserts revisions in one statement and transaction."""
+
+        with self.app.app_context():
+            try:
+                db.session.execute(db.insert(FeedbackRevision), rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def _handle_failure(self, batch):
+        """
+        Deals with a batch that failed to insert.
+        Puts the batch back and schedules a retry.  Once the batch has been failing
+        for REVISION_GIVE_UP_AFTER seconds, instead inserts its revisions one at a
+        time, and gives up on the ones that fail.
+        Returns the number of revisions inserted.
+        """
+
+        config = self.app.config
+        now = time.monotonic()
+
+        self._failures += 1
+        self._retry_at = now + min(
+            config["REVISION_RETRY_INTERVAL"] * 2 ** (self._failures - 1),
+            MAX_RETRY_DELAY)
+
+        if self._failing_since is None:
+            self._failing_since = now
+
+        if now - self._failing_since < config["REVISION_GIVE_UP_AFTER"]:
+            with self._buffer_lock:
+                # Put the batch back in front, to be retried.
+                self._buffer[:0] = batch
+                overflow = len(self._buffer) - config["REVISION_MAX_BUFFER_SIZE"]
+                dropped = self._buffer[:max(overflow, 0)]
+                del self._buffer[:len(dropped)]
+
+            self._give_up(dropped, "buffer is full")
+            return 0
+
+        # The next batch gets its own REVISION_GIVE_UP_AFTER seconds.
+        self._failing_since = None
+
+        failed = []
+        for row in batch:
+            try:
+                self._insert([row])
+            except Exception:
+                failed.append(row)
+
+        give_up_after = config["REVISION_GIVE_UP_AFTER"]
+        self._give_up(failed, f"insert failed for {give_up_after} seconds")
+
+        return len(batch) - len(failed)
+
+    def _give_up(self, rows, reason):
+        """Logs revisions that will not be inserted."""
+
+        for row in rows:
+            self.app.logger.error(
+                "Dropped feedback revision, %s: %r", reason, row)
+
+    def _run(self):
+        """
+        Background loop that flushes on every wakeup or interval, except while
+        waiting to retry a failed insert.
+        """
+
+        while True:
+            if self._retry_at is None:
+                timeout = self.app.config["REVISION_FLUSH_INTERVAL"]
+            else:
+                timeout = max(self._retry_at - time.monotonic(), 0)
+
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+            # close() inserts what is left.
+            if self._closed:
+                return
+
+            if self._retry_at is not None and time.monotonic() < self._retry_at:
+                continue
+
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Failed to write feedback revisions.")